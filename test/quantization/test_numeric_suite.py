@@ -1,3 +1,6 @@
+import copy
+import unittest
+
 import torch
 import torch.nn as nn
 import torch.nn.quantized as nnq
@@ -11,12 +14,15 @@ from torch.quantization import (
     quantize,
 )
 from torch.quantization._numeric_suite import (
+    OutputLogger,
     Shadow,
     ShadowLogger,
     compare_model_outputs,
     compare_model_stub,
     compare_weights,
+    get_logger_dict,
 )
+from torch.testing._internal.common_cuda import TEST_CUDA, TEST_MULTIGPU
 from torch.testing._internal.common_quantization import (
     AnnotatedConvBnReLUModel,
     AnnotatedConvModel,
@@ -219,3 +225,226 @@ class TestEagerModeNumericSuite(QuantizationTestCase):
                 )
                 for k, v in act_compare_dict.items():
                     self.assertTrue(v["float"].shape == v["quantized"].shape)
+
+    def test_compare_model_outputs_chunked(self):
+        r"""Running the input in chunks logs the same activations as running it
+        in one batch
+        """
+        for qengine in supported_qengines:
+            with override_quantized_engine(qengine):
+                model = AnnotatedConvModel(qengine).eval()
+                q_model = quantize(model, default_eval_fn, self.img_data)
+                data = torch.cat([self.img_data[0][0]] * 4)
+                act_compare_dict = compare_model_outputs(
+                    copy.deepcopy(model), copy.deepcopy(q_model), data
+                )
+                chunked_act_compare_dict = compare_model_outputs(
+                    model, q_model, data, chunk_size=data.size(0) // 2
+                )
+                self.assertEqual(
+                    act_compare_dict.keys(), chunked_act_compare_dict.keys()
+                )
+                for k, v in chunked_act_compare_dict.items():
+                    torch.testing.assert_allclose(
+                        v["float"], act_compare_dict[k]["float"]
+                    )
+                    torch.testing.assert_allclose(
+                        v["quantized"].dequantize(),
+                        act_compare_dict[k]["quantized"].dequantize(),
+                    )
+
+    def test_logger_materialize(self):
+        r"""Outputs logged over several forward calls are concatenated once
+        when the stats are read
+        """
+        logger = OutputLogger()
+        x = torch.randn(2, 3)
+        for _ in range(3):
+            logger(x)
+        stats = logger.materialize()
+        self.assertEqual(stats["tensor_val"].shape, (6, 3))
+        torch.testing.assert_allclose(stats["tensor_val"], torch.cat([x] * 3))
+        self.assertEqual(len(logger.stats["tensor_val"]), 1)
+
+        # Logging can continue after the stats are read
+        logger(x)
+        self.assertEqual(logger.materialize()["tensor_val"].shape, (8, 3))
+
+        shadow_logger = ShadowLogger()
+        for _ in range(2):
+            shadow_logger(x, x)
+        stats = shadow_logger.materialize()
+        self.assertEqual(stats["quantized"].shape, (4, 3))
+        self.assertEqual(stats["float"].shape, (4, 3))
+
+    def test_logger_materialize_quantized(self):
+        r"""Quantized outputs logged over several forward calls keep their
+        quantization parameters when concatenated
+        """
+        logger = OutputLogger()
+        x = torch.rand(2, 3)
+        qx = torch.quantize_per_tensor(x, 0.1, 2, torch.quint8)
+        logger(qx)
+        logger(qx)
+        stats = logger.materialize()
+        self.assertTrue(stats["tensor_val"].is_quantized)
+        self.assertEqual(stats["tensor_val"].q_scale(), 0.1)
+        self.assertEqual(stats["tensor_val"].q_zero_point(), 2)
+        torch.testing.assert_allclose(
+            stats["tensor_val"].dequantize(), torch.cat([qx.dequantize()] * 2)
+        )
+
+        # Outputs with different quantization parameters fall back to a
+        # quantized cat, which uses the parameters of the first output
+        logger = OutputLogger()
+        qx2 = torch.quantize_per_tensor(x, 0.2, 2, torch.quint8)
+        logger(qx)
+        logger(qx2)
+        stats = logger.materialize()
+        self.assertEqual(stats["tensor_val"].q_scale(), 0.1)
+        torch.testing.assert_allclose(
+            stats["tensor_val"].dequantize(),
+            torch.cat([qx.dequantize(), qx2.dequantize()]),
+        )
+
+    def test_output_logger_modes(self):
+        r"""OutputLogger keeps a bounded sample or running statistics of the
+        outputs instead of the full history
+        """
+        xs = [torch.randn(4, 3, 2) for _ in range(10)]
+
+        logger = OutputLogger(mode="reservoir", k=8)
+        scaled_logger = OutputLogger(mode="reservoir", k=8)
+        for x in xs:
+            logger(x)
+            scaled_logger(x * 2)
+        sample = logger.materialize()["tensor_val"]
+        self.assertEqual(sample.shape, (8, 3, 2))
+        # Loggers fed with outputs of the same shapes keep the same rows
+        torch.testing.assert_allclose(
+            scaled_logger.materialize()["tensor_val"], sample * 2
+        )
+        # Scripted loggers keep the same rows as eager ones
+        scripted_logger = torch.jit.script(OutputLogger(mode="reservoir", k=8))
+        for x in xs:
+            scripted_logger(x)
+        torch.testing.assert_allclose(
+            scripted_logger.materialize()["tensor_val"], sample
+        )
+        # The sample is spread over the whole stream of rows
+        logger = OutputLogger(mode="reservoir", k=256)
+        logger(torch.arange(4096, dtype=torch.float))
+        sample = logger.materialize()["tensor_val"]
+        self.assertEqual(sample.shape, (256,))
+        counts = torch.histc(sample, bins=4, min=0, max=4096)
+        self.assertTrue(((counts > 40) & (counts < 90)).all())
+
+        logger = OutputLogger(mode="stats")
+        for x in xs:
+            logger(x)
+        running_stats = logger.materialize()["tensor_val"]
+        x = torch.cat(xs).transpose(0, 1).reshape(3, -1).double()
+        expected_stats = torch.stack([
+            x.min(1)[0],
+            x.max(1)[0],
+            x.sum(1),
+            (x * x).sum(1),
+            torch.full((3,), x.size(1), dtype=torch.double),
+        ])
+        torch.testing.assert_allclose(running_stats, expected_stats)
+
+    def test_get_logger_dict_custom_logger(self):
+        r"""Custom loggers that do not derive from Logger are read through
+        their stats attribute
+        """
+        class CustomLogger(nn.Module):
+            def __init__(self):
+                super(CustomLogger, self).__init__()
+                self.stats = {"tensor_val": None}
+
+            def forward(self, x):
+                self.stats["tensor_val"] = x
+                return x
+
+        model = nn.Sequential(nn.ReLU())
+        model[0].logger = CustomLogger()
+        x = torch.randn(2, 3)
+        model[0].logger(x)
+        logger_dict = get_logger_dict(model, CustomLogger)
+        self.assertEqual(logger_dict.keys(), {"0.stats"})
+        self.assertIs(logger_dict["0.stats"]["tensor_val"], x)
+
+    @unittest.skipIf(not TEST_CUDA, "CUDA is not available")
+    def test_logger_offloads_cuda_outputs(self):
+        r"""Outputs of modules running on GPU are logged in host memory
+        """
+        x = torch.randn(2, 3, device="cuda")
+        for pin_memory in [False, True]:
+            logger = OutputLogger()
+            logger.pin_memory = pin_memory
+            for _ in range(2):
+                self.assertTrue(logger(x).is_cuda)
+            stats = logger.materialize()
+            self.assertFalse(stats["tensor_val"].is_cuda)
+            torch.testing.assert_allclose(
+                stats["tensor_val"], torch.cat([x, x]).cpu()
+            )
+
+        for mode in ["reservoir", "stats"]:
+            logger = OutputLogger(mode=mode, k=1)
+            logger(x)
+            logger(x)
+            self.assertFalse(logger.materialize()["tensor_val"].is_cuda)
+
+    def test_shadow_scriptable(self):
+        r"""Shadow module with ShadowLogger can be scripted and logs the same
+        outputs as in eager mode
+        """
+        for qengine in supported_qengines:
+            with override_quantized_engine(qengine):
+                model = AnnotatedConvModel(qengine).eval()
+                q_model = quantize(model, default_eval_fn, self.img_data)
+                data = q_model.quant(self.img_data[0][0])
+                shadow = Shadow(q_model.conv, model.conv, ShadowLogger)
+                scripted = torch.jit.script(
+                    Shadow(q_model.conv, model.conv, ShadowLogger)
+                )
+                shadow(data)
+                scripted(data)
+                stats = shadow.logger.materialize()
+                scripted_stats = scripted.logger.materialize()
+                torch.testing.assert_allclose(
+                    scripted_stats["float"], stats["float"]
+                )
+                torch.testing.assert_allclose(
+                    scripted_stats["quantized"].dequantize(),
+                    stats["quantized"].dequantize(),
+                )
+
+    def test_output_logger_scriptable(self):
+        r"""OutputLogger can be scripted, and reading its stats concatenates the
+        logged outputs only once
+        """
+        scripted = torch.jit.script(OutputLogger())
+        x = torch.randn(2, 3)
+        for _ in range(3):
+            scripted(x)
+        stats = scripted.materialize()
+        torch.testing.assert_allclose(stats["tensor_val"], torch.cat([x] * 3))
+        self.assertEqual(len(scripted.stats["tensor_val"]), 1)
+        scripted(x)
+        self.assertEqual(scripted.materialize()["tensor_val"].shape, (8, 3))
+
+    @unittest.skipIf(not TEST_MULTIGPU, "multi-GPU not supported")
+    def test_logger_offloads_non_current_device_outputs(self):
+        r"""Pinned copies of outputs logged on a GPU other than the current
+        one are complete when the stats are read
+        """
+        logger = OutputLogger()
+        logger.pin_memory = True
+        x = torch.randn(1024, 1024, device="cuda:1")
+        with torch.cuda.device(0):
+            for _ in range(4):
+                logger(x * 2)
+            stats = logger.materialize()
+        torch.testing.assert_allclose(stats["tensor_val"], torch.cat([x * 2] * 4).cpu())
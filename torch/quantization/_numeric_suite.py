@@ -1,24 +1,36 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from typing import Dict, List
+
 import torch
 import torch.nn as nn
-import torch.nn.quantized as nnq
 from torch.quantization import prepare
 
 from .default_mappings import DEFAULT_NUMERIC_SUITE_COMPARE_MODEL_OUTPUT_WHITE_LIST
 
 
-def _find_match(str_list, key_str, postfix):
-    split_str = key_str.split(".")
-    if split_str[-1] == postfix:
-        match_string = "".join(key_str.split(".")[0:-1])
-        for s2 in str_list:
-            pattern1 = "".join(s2.split(".")[0:-1])
-            pattern2 = "".join(s2.split(".")[0:-2])
-            if match_string == pattern1:
-                return s2
-            if match_string == pattern2:
-                return s2
+def _build_match_index(str_list):
+    r"""Build the lookup table used by _find_match. Each key in str_list is
+    indexed by its name with the last one and the last two components
+    stripped. The first key producing a given name wins, matching the order in
+    which a linear scan over str_list would find it.
+    """
+    match_index = {}
+    for s2 in str_list:
+        pattern1 = s2.rpartition(".")[0]
+        pattern2 = pattern1.rpartition(".")[0]
+        match_index.setdefault(pattern1, s2)
+        match_index.setdefault(pattern2, s2)
+    return match_index
+
+
+def _find_match(match_index, key_str, postfix):
+    # Cheap rejection for the common case of keys with a different postfix
+    if not key_str.endswith(postfix):
+        return None
+    match_string, _, last = key_str.rpartition(".")
+    if last == postfix:
+        return match_index.get(match_string)
     else:
         return None
 
@@ -45,12 +57,14 @@ def compare_weights(float_dict, quantized_dict):
         quantized weights
     """
     weight_dict = {}
+    float_index = _build_match_index(float_dict)
     for key in quantized_dict:
-        match_key = _find_match(float_dict, key, "weight")
+        match_key = _find_match(float_index, key, "weight")
         if match_key is not None:
-            weight_dict[key] = {}
-            weight_dict[key]["float"] = float_dict[match_key]
-            weight_dict[key]["quantized"] = quantized_dict[key]
+            weight_dict[key] = {
+                "float": float_dict[match_key],
+                "quantized": quantized_dict[key],
+            }
     return weight_dict
 
 
@@ -64,17 +78,23 @@ def _get_logger_dict_helper(mod, target_dict, Logger, prefix=""):
         target_dict: the dictionary used to save all logger stats
     """
 
-    def get_prefix(prefix):
-        return prefix if prefix == "" else prefix + "."
+    prefix_dot = prefix if prefix == "" else prefix + "."
+    stats_key = prefix_dot + "stats"
 
     for name, child in mod.named_children():
+        # isinstance also filters on the requested logger type, and is cheaper
+        # than probing a marker attribute: a miss on a regular module goes
+        # through nn.Module.__getattr__, which raises
         if isinstance(child, Logger):
-            target_dict[get_prefix(prefix) + "stats"] = child.stats
-            break
-
-    for name, child in mod.named_children():
-        module_prefix = get_prefix(prefix) + name if prefix else name
-        _get_logger_dict_helper(child, target_dict, Logger, module_prefix)
+            # Only the first logger attached to a module is reported
+            if stats_key not in target_dict:
+                # Custom loggers that do not derive from Logger only need stats
+                materialize = getattr(child, "materialize", None)
+                target_dict[stats_key] = (
+                    materialize() if materialize is not None else child.stats
+                )
+            continue
+        _get_logger_dict_helper(child, target_dict, Logger, prefix_dot + name)
 
 
 def get_logger_dict(mod, Logger, prefix=""):
@@ -100,55 +120,248 @@ def get_logger_dict(mod, Logger, prefix=""):
     return target_dict
 
 
+def _shared_per_tensor_qparams(tensors):
+    r"""Return (dtype, scale, zero_point) if all tensors are per tensor
+    quantized with the same parameters, None otherwise.
+    """
+    qparams = None
+    for t in tensors:
+        if not t.is_quantized or t.qscheme() != torch.per_tensor_affine:
+            return None
+        t_qparams = (t.dtype, t.q_scale(), t.q_zero_point())
+        if qparams is None:
+            qparams = t_qparams
+        elif t_qparams != qparams:
+            return None
+    return qparams
+
+
+def _cat_tensor_list(tensors):
+    r"""Concatenate logged tensors along dim 0. Quantized tensors sharing the
+    same per tensor quantization parameters are concatenated on their integer
+    representation, which avoids the requantization done by a quantized cat.
+    """
+    qparams = _shared_per_tensor_qparams(tensors)
+    if qparams is None:
+        return torch.cat(tensors)
+    _, scale, zero_point = qparams
+    int_repr = torch.cat([t.int_repr() for t in tensors])
+    return torch._make_per_tensor_quantized_tensor(int_repr, scale, zero_point)
+
+
 class Logger(nn.Module):
     r"""Base class for stats logging
+
+    Outputs logged on a GPU are copied to host memory. By default the copy is
+    synchronous into pageable memory. Setting ``pin_memory`` to True copies
+    asynchronously into pinned memory instead, which overlaps the copies with
+    compute but keeps the logged history page-locked: the caching host
+    allocator does not give freed pinned memory back to the system.
     """
+    __annotations__ = {"_copy_devices": List[int]}
 
     def __init__(self):
         super(Logger, self).__init__()
         self.stats = {}
+        self.pin_memory = False
+        # Indices of the GPUs with asynchronous copies not yet waited for
+        self._copy_devices = []
 
     def forward(self, x):
         pass
 
+    def _to_host(self, x):
+        r"""Detach x if it requires grad and, if it lives on a GPU, copy it to
+        host memory so that logging does not hold on to device memory. With
+        pin_memory set the copy is asynchronous and materialize() waits for it.
+        """
+        if x.requires_grad:
+            x = x.detach()
+        if x.is_cuda:
+            if self.pin_memory:
+                host = torch.empty(x.size(), dtype=x.dtype, pin_memory=True)
+                host.copy_(x, non_blocking=True)
+                device = x.get_device()
+                if device not in self._copy_devices:
+                    self._copy_devices.append(device)
+                x = host
+            else:
+                x = x.cpu()
+        return x
+
+    @torch.jit.ignore
+    def _wait_for_copies(self):
+        r"""Wait for the asynchronous copies started by _to_host on every GPU
+        they were issued from.
+        """
+        for device in self._copy_devices:
+            torch.cuda.synchronize(device)
+        self._copy_devices = []
+
+    @torch.jit.ignore
+    def materialize(self):
+        r"""Return the logged stats with every list of tensors collected across
+        forward calls concatenated along dim 0. The concatenation is done once
+        and cached back into the stats, so logging can continue afterwards and
+        repeated calls do not copy the history again.
+        """
+        self._wait_for_copies()
+        # On a scripted logger self.stats returns a converted copy, so the
+        # concatenated stats are assigned back explicitly
+        stats = self.stats
+        materialized = {}
+        for key, val in stats.items():
+            if isinstance(val, list):
+                if len(val) > 1:
+                    val[:] = [_cat_tensor_list(val)]
+                val = val[0] if val else None
+            materialized[key] = val
+        self.stats = stats
+        return materialized
+
 
 class ShadowLogger(Logger):
     r"""Class used in Shadow module to record the outputs of the original and
     shadow modules.
     """
+    __annotations__ = {
+        "stats": Dict[str, List[torch.Tensor]],
+        "_copy_devices": List[int],
+    }
 
     def __init__(self):
         super(ShadowLogger, self).__init__()
-        self.stats["float"] = None
-        self.stats["quantized"] = None
+        self.stats["float"] = []
+        self.stats["quantized"] = []
 
     def forward(self, x, y):
-        if self.stats["quantized"] is None:
-            self.stats["quantized"] = x.detach()
-        else:
-            self.stats["quantized"] = torch.cat((self.stats["quantized"], x.detach()))
-
-        if self.stats["float"] is None:
-            self.stats["float"] = y.detach()
-        else:
-            self.stats["float"] = torch.cat((self.stats["float"], y.detach()))
+        self.stats["quantized"].append(self._to_host(x))
+        self.stats["float"].append(self._to_host(y))
 
 
 class OutputLogger(Logger):
     r"""Class used to log the outputs of the module
+
+    Args:
+        mode: how the outputs are logged in stats["tensor_val"].
+            ``'full'`` keeps every output.
+            ``'reservoir'`` keeps a random sample of at most ``k`` rows (slices
+            along dim 0) of the outputs, which is close to uniform for fewer
+            than 2^30 logged rows. The sample is drawn with a fixed seed,
+            so loggers seeing outputs of the same shapes, e.g. in a float
+            model and its quantized counterpart, keep the same rows.
+            ``'stats'`` keeps running per channel (dim 1) statistics of the
+            outputs as a float64 tensor of shape (5, C), whose rows are the
+            min, max, sum, sum of squares and number of elements. The
+            running statistics stay on the device of the outputs while
+            logging and are moved to host memory by materialize().
+        k: number of rows kept in ``'reservoir'`` mode
+
+    To use a mode other than ``'full'`` with compare_model_outputs, pass a
+    subclass of OutputLogger whose constructor takes no arguments.
     """
+    __annotations__ = {
+        "stats": Dict[str, List[torch.Tensor]],
+        "_copy_devices": List[int],
+        "_reservoir": List[torch.Tensor],
+    }
 
-    def __init__(self):
+    def __init__(self, mode="full", k=1024):
         super(OutputLogger, self).__init__()
-        self.stats["tensor_val"] = None
+        assert mode in ("full", "reservoir", "stats"), \
+            "mode must be one of 'full', 'reservoir' or 'stats', got {}".format(mode)
+        self.mode = mode
+        self.k = k
+        self.stats["tensor_val"] = []
+        self._reservoir = []
+        self._num_seen = 0
+        self._rng_state = 0
 
     def forward(self, x):
-        if self.stats["tensor_val"] is None:
-            self.stats["tensor_val"] = x
+        if self.mode == "reservoir":
+            self._update_reservoir(x)
+        elif self.mode == "stats":
+            self._update_running_stats(x)
         else:
-            self.stats["tensor_val"] = torch.cat((self.stats["tensor_val"], x))
+            self.stats["tensor_val"].append(self._to_host(x))
         return x
 
+    def _update_reservoir(self, x):
+        # type: (torch.Tensor) -> None
+        for i in range(x.size(0)):
+            slot = self._num_seen
+            if slot >= self.k:
+                slot = self._next_random() % (self._num_seen + 1)
+            self._num_seen = self._num_seen + 1
+            if slot < self.k:
+                row = x.narrow(0, i, 1)
+                if row.is_cuda:
+                    # _to_host already copies the row off the device
+                    row = self._to_host(row)
+                else:
+                    # Do not keep the whole output alive through a view
+                    row = row.detach().clone()
+                if slot == len(self._reservoir):
+                    self._reservoir.append(row)
+                else:
+                    self._reservoir[slot] = row
+
+    def _next_random(self):
+        # type: () -> int
+        # Linear congruential generator, so that the same rows are picked in
+        # eager mode and in TorchScript. Its low bits have short periods, so
+        # the high 15 bits of two consecutive states form a 30 bit value.
+        value = 0
+        for _ in range(2):
+            self._rng_state = (self._rng_state * 1103515245 + 12345) % 2147483648
+            value = value * 32768 + self._rng_state // 65536
+        return value
+
+    def _update_running_stats(self, x):
+        # type: (torch.Tensor) -> None
+        if x.is_quantized:
+            x = x.dequantize()
+        x = x.detach()
+        if x.dim() > 1:
+            x = x.transpose(0, 1)
+            x = x.reshape(x.size(0), -1)
+        else:
+            x = x.reshape(1, -1)
+        x = x.double()
+        batch_stats = torch.stack([
+            torch.min(x, 1)[0],
+            torch.max(x, 1)[0],
+            x.sum(1),
+            (x * x).sum(1),
+            torch.full((x.size(0),), float(x.size(1)), dtype=x.dtype, device=x.device),
+        ])
+        tensor_val = self.stats["tensor_val"]
+        if len(tensor_val) == 0:
+            tensor_val.append(batch_stats)
+        else:
+            running_stats = tensor_val[0]
+            tensor_val[0] = torch.cat([
+                torch.min(running_stats[:1], batch_stats[:1]),
+                torch.max(running_stats[1:2], batch_stats[1:2]),
+                running_stats[2:] + batch_stats[2:],
+            ])
+
+    @torch.jit.ignore
+    def materialize(self):
+        if self.mode == "stats":
+            materialized = Logger.materialize(self)
+            tensor_val = materialized["tensor_val"]
+            if tensor_val is not None:
+                materialized["tensor_val"] = tensor_val.cpu()
+            return materialized
+        if self.mode != "reservoir":
+            return Logger.materialize(self)
+        self._wait_for_copies()
+        # The sample is built from self._reservoir directly, since the slots
+        # keep being replaced as logging continues
+        reservoir = self._reservoir
+        return {"tensor_val": _cat_tensor_list(reservoir) if reservoir else None}
+
 
 class Shadow(nn.Module):
     r"""Shadow module attaches the float module to its matching quantized module
@@ -166,13 +379,18 @@ class Shadow(nn.Module):
         super(Shadow, self).__init__()
         self.orig_module = q_module
         self.shadow_module = float_module
-        self.dequant = nnq.DeQuantize()
         self.logger = Logger()
 
     def forward(self, x):
-        output = self.orig_module(x)
-        x = x.dequantize()
-        shadow_output = self.shadow_module(x)
+        if torch.jit.is_scripting():
+            # Run the float shadow module concurrently with the quantized one.
+            # In eager mode fork would run it inline, so it is only used here.
+            fut = torch.jit._fork(self.shadow_module, x.dequantize())
+            output = self.orig_module(x)
+            shadow_output = torch.jit._wait(fut)
+        else:
+            output = self.orig_module(x)
+            shadow_output = self.shadow_module(x.dequantize())
         self.logger(output, shadow_output)
         return output
 
@@ -239,22 +457,19 @@ def prepare_model_with_stubs(float_module, q_module, module_swap_list, Logger):
             quantized module and its float shadow module
     """
 
-    float_module_children = {}
-    for name, mod in float_module.named_children():
-        float_module_children[name] = mod
+    float_module_children = dict(float_module.named_children())
 
     reassign = {}
     for name, mod in q_module.named_children():
-        if name not in float_module_children:
+        float_mod = float_module_children.get(name)
+        if float_mod is None:
             continue
 
-        float_mod = float_module_children[name]
-
-        if type(float_mod) not in module_swap_list:
-            prepare_model_with_stubs(float_mod, mod, module_swap_list, Logger)
-
         if type(float_mod) in module_swap_list:
             reassign[name] = Shadow(mod, float_mod, Logger)
+        elif float_mod._modules and mod._modules:
+            # Only recurse if both modules have children to pair up
+            prepare_model_with_stubs(float_mod, mod, module_swap_list, Logger)
 
     for key, value in reassign.items():
         q_module._modules[key] = value
@@ -293,8 +508,11 @@ def compare_model_stub(
         Logger: type of logger to be used in shadow module to process the outputs of
             quantized module and its float shadow module
     """
-    prepare_model_with_stubs(float_model, q_model, module_swap_list, Logger)
-    q_model(data)
+    module_swap_set = frozenset(module_swap_list)
+    prepare_model_with_stubs(float_model, q_model, module_swap_set, Logger)
+    q_model.eval()
+    with torch.no_grad():
+        q_model(data)
     ob_dict = get_logger_dict(q_model, Logger)
     return ob_dict
 
@@ -315,12 +533,14 @@ def get_matching_activations(float_module, q_module, Logger):
     float_dict = get_logger_dict(float_module, Logger)
     quantized_dict = get_logger_dict(q_module, Logger)
     act_dict = {}
+    float_index = _build_match_index(sorted(float_dict, reverse=True))
     for key in quantized_dict:
-        match_key = _find_match(sorted(float_dict, reverse=True), key, "stats")
+        match_key = _find_match(float_index, key, "stats")
         if match_key is not None:
-            act_dict[key] = {}
-            act_dict[key]["float"] = float_dict[match_key]["tensor_val"]
-            act_dict[key]["quantized"] = quantized_dict[key]["tensor_val"]
+            act_dict[key] = {
+                "float": float_dict[match_key]["tensor_val"],
+                "quantized": quantized_dict[key]["tensor_val"],
+            }
     return act_dict
 
 
@@ -339,6 +559,7 @@ def prepare_model_outputs(
         Logger: type of logger to be attached to float_module and q_module
         white_list: list of module types to attach logger
     """
+    white_list = frozenset(white_list)
     qconfig_debug = torch.quantization.QConfig(activation=Logger, weight=None)
     float_module.qconfig = qconfig_debug
     prepare(float_module, inplace=True, white_list=white_list)
@@ -352,6 +573,7 @@ def compare_model_outputs(
     data,
     Logger=OutputLogger,
     white_list=DEFAULT_NUMERIC_SUITE_COMPARE_MODEL_OUTPUT_WHITE_LIST,
+    chunk_size=None,
 ):
     r"""Compare output activations between float and quantized models at
     corresponding locations for the same input. Return a dict with key corresponding
@@ -371,6 +593,10 @@ def compare_model_outputs(
         data: input data used to run the prepared float_model and q_model
         Logger: type of logger to be attached to float_module and q_module
         white_list: list of module types to attach logger
+        chunk_size: if set, data is split into chunks of this size along dim 0
+            and each chunk is run through float_model and then q_model before
+            moving on to the next one, which keeps the working set small for
+            large inputs
 
     Return:
         act_compare_dict: dict with key corresponding to quantized module names
@@ -378,7 +604,15 @@ def compare_model_outputs(
         containing the matching float and quantized activations
     """
     prepare_model_outputs(float_model, q_model, Logger, white_list)
-    float_model(data)
-    q_model(data)
+    float_model.eval()
+    q_model.eval()
+    with torch.no_grad():
+        if chunk_size is None:
+            float_model(data)
+            q_model(data)
+        else:
+            for chunk in torch.split(data, chunk_size):
+                float_model(chunk)
+                q_model(chunk)
     act_compare_dict = get_matching_activations(float_model, q_model, Logger)
     return act_compare_dict